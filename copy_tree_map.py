@@ -20,58 +20,461 @@
 """
 
 import argparse
+import asyncio
+import contextlib
+import errno
+import fnmatch
 import functools
 import os
-import pathlib
+import queue
 import re
 import shutil
+import stat
 import subprocess
 import sys
+import tempfile
 import textwrap
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import cpu_count
 
+try:
+    import posix
+except ImportError:  # e.g Windows
+    posix = None
+
+try:
+    import av  # PyAV, optional
+except ImportError:
+    av = None
+
 __author__   = "Markus Holmström (MawKKe)"
 __email__    = "markus@mawkke.fi"
 __license__  = "Apache 2.0"
 __homepage__ = "https://github.com/MawKKe/copy-tree-map"
 
 
-def ffmpeg_conv(src, dst, codec, bitrate):
+# At most this many files are converted by a single ffmpeg process
+_FFMPEG_BATCH = 8
+
+
+@functools.lru_cache(maxsize=None)
+def _ffmpeg_args(codec, bitrate, threads):
+    # The parts of the ffmpeg command line: the leading ones, and the ones that
+    # precede each input and each output file. They only depend on the rule, so
+    # they are built once per rule.
+
+    # 'threads' limits the number of threads ffmpeg uses for decoding and encoding;
+    # by default ffmpeg picks a thread count based on the number of cpus.
+    thr = ("-threads", str(threads)) if threads else ()
+
+    # With -nostdin, ffmpeg does not stop to ask whether to overwrite a file
+    return (("ffmpeg", "-nostdin", "-loglevel", "warning"),
+            (*thr, "-i"),
+            ("-c:a", codec, "-b:a", bitrate, *thr, "-vn"))
+
+
+@functools.lru_cache(maxsize=None)
+def _pyav_encoder(codec):
+    # The libav encoder named 'codec', or None if PyAV is not installed or
+    # does not know of such encoder
+    if av is None:
+        return None
+    try:
+        return av.codec.Codec(codec, "w")
+    except ValueError:
+        return None
 
-    cmd = ["ffmpeg", "-loglevel", "warning", "-i", src, "-c:a", codec, "-b:a", bitrate, "-vn", dst]
 
-    def inner():
+@functools.lru_cache(maxsize=None)
+def _pyav_layout(codec, layout, rate):
+    # The channel layout to encode with. PyAV does not tell which layouts an
+    # encoder supports (e.g libmp3lame only does mono and stereo), so the encoder
+    # is tried with the input layout first, then downmixing to stereo or mono like
+    # ffmpeg would.
+    encoder = _pyav_encoder(codec)
+    for candidate in dict.fromkeys((layout, "stereo", "mono")):
+        ctx = av.CodecContext.create(encoder)
+        ctx.rate = rate
+        ctx.layout = candidate
+        ctx.format = encoder.audio_formats[0] if encoder.audio_formats else "s16"
         try:
-            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            proc.check_returncode()
-            return (True, "")
-        except subprocess.CalledProcessError as e:
-            return (False, e.stderr.decode('utf8').strip())
+            ctx.open()
+        except av.error.FFmpegError:
+            continue
+        return candidate
+    return layout  # let the conversion itself report the error
+
+
+def _pyav_conv(src, dst, encoder, bitrate, threads=None):
+    # Same conversion as the ffmpeg command of ffmpeg_conv(), but done in-process
+    # with PyAV; no ffmpeg process needs to be started and initialized per file.
+    with av.open(src) as inp, av.open(dst, "w") as out:
+        istream = inp.streams.audio[0]
+
+        # Like ffmpeg, use the closest sample rate the encoder supports,
+        # preferring higher ones (e.g libopus does not support 44.1 kHz)
+        rate = istream.rate
+        if encoder.audio_rates and rate not in encoder.audio_rates:
+            rate = min(encoder.audio_rates, key=lambda r: (r < rate, abs(r - rate)))
+
+        layout = _pyav_layout(encoder.name, istream.layout.name, rate)
+        ostream = out.add_stream(encoder.name, rate=rate, layout=layout)
+        ostream.bit_rate = int(bitrate[:-1]) * 1000
+        if threads:
+            istream.codec_context.thread_count = threads
+            ostream.codec_context.thread_count = threads
+
+        # ffmpeg copies the metadata by default
+        out.metadata.update(inp.metadata)
+        ostream.metadata.update(istream.metadata)
+
+        for frame in inp.decode(istream):
+            for packet in ostream.encode(frame):
+                out.mux(packet)
+        for packet in ostream.encode(None):  # flush
+            out.mux(packet)
+
+
+async def ffmpeg_conv(src, dst, codec, bitrate, threads=None):
+
+    # Prefer PyAV if available; libav then runs in a thread of the default executor
+    encoder = _pyav_encoder(codec)
+
+    # The output may already exist if another input has the same name, but a
+    # different extension (e.g a.flac and a.wav, both converted to a.ogg). It is
+    # never overwritten; ffmpeg even refuses to, but still exits with success.
+    if os.path.lexists(dst):
+        cmd = ["ffmpeg" if encoder is None else "pyav"]
+        return {"success": False, "src": src, "dst": dst, "cmd": cmd,
+                "msg": "the output file already exists"}
+
+    if encoder is not None:
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, _pyav_conv, src, dst, encoder, bitrate, threads)
+            ret, msg = True, ""
+        except Exception as e:
+            ret, msg = False, str(e)
+        return {"success": ret, "src": src, "dst": dst, "cmd": ["pyav"], "msg": msg}
+
+    cmd, (msg,) = await _ffmpeg_convert([(src, dst)], codec, bitrate, threads)
+
+    return {"success": msg is None, "src": src, "dst": dst, "cmd": cmd, "msg": msg or ""}
 
-    ret, msg = inner()
 
-    return {"success": ret, "src": src, "dst": dst, "cmd": cmd, "msg": msg}
+async def ffmpeg_conv_batch(jobs, codec, bitrate, threads=None):
+    """
+    Like ffmpeg_conv(), but for a list of (src, dst) pairs that are converted with
+    the same rule. They are converted by a single ffmpeg process, which is
+    started and initialized only once for all of them. Returns a list of results.
+
+    Each file whose output the process did not produce is converted again on its
+    own, so that its failure is reported for the right file. If the process
+    fails, there is no telling which of the files caused it, so that is all of them.
+    """
+    cmd, errors = await _ffmpeg_convert(jobs, codec, bitrate, threads)
 
+    results = []
+    for (src, dst), msg in zip(jobs, errors):
+        if msg is None:
+            results.append({"success": True, "src": src, "dst": dst, "cmd": cmd, "msg": ""})
+        else:
+            results.append(await ffmpeg_conv(src, dst, codec, bitrate, threads))
+    return results
 
-def copyjob(src, dst, *args, **kwargs):
+
+def _temp_name(dst):
+    # A name for a file next to dst, that does not exist yet. The extension is
+    # kept, since ffmpeg picks the output format by it.
+    head, tail = os.path.split(dst)
+    stem, ext = os.path.splitext(tail)
+    return os.path.join(head, ".{}.{}{}".format(stem, os.urandom(8).hex(), ext))
+
+
+def _place_output(tmp, dst):
+    # Move the finished output tmp to dst, but never over an existing file. A hard
+    # link cannot replace dst; where links are not supported, the check and the
+    # rename are separate steps.
     try:
-        shutil.copy2(src, dst, *args, **kwargs)
+        os.link(tmp, dst)
+    except FileExistsError:
+        raise
+    except OSError:
+        if os.path.lexists(dst):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+        os.replace(tmp, dst)
+        return
+    os.unlink(tmp)
+
+
+async def _ffmpeg_convert(jobs, codec, bitrate, threads):
+    # Convert the (src, dst) pairs of jobs with a single ffmpeg process. Returns
+    # the command and, for each job, None if its output was written, otherwise an
+    # error message.
+    #
+    # ffmpeg exits with success even if it skipped some outputs, e.g because such
+    # a file exists. So each output is first written under a new temporary name
+    # next to dst. It is moved to dst only if ffmpeg created it, and never over a
+    # file that exists by then. A failed process leaves only its own files to remove.
+    head, in_args, out_args = _ffmpeg_args(codec, bitrate, threads)
+    temps = [_temp_name(dst) for _, dst in jobs]
+
+    cmd = [*head]
+    for src, _ in jobs:
+        cmd += [*in_args, src]
+    for i, tmp in enumerate(temps):
+        # Without the explicit -map_metadata, all outputs would get the global
+        # metadata (tags) of the first input
+        maps = ["-map", "{}:a:0".format(i), "-map_metadata", str(i)] if len(jobs) > 1 else []
+        cmd += [*maps, *out_args, tmp]
+
+    ok, msg = await _run_ffmpeg(cmd)
+
+    errors = []
+    for (_, dst), tmp in zip(jobs, temps):
+        err = None if ok else msg
+        if err is None and not os.path.isfile(tmp):
+            err = "ffmpeg did not write the output file"
+        if err is None:
+            try:
+                _place_output(tmp, dst)
+            except FileExistsError:
+                err = "the output file already exists"
+            except OSError as e:
+                err = str(e)
+        if err is not None:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass  # e.g never created
+        errors.append(err)
+    return cmd, errors
+
+
+async def _run_ffmpeg(cmd):
+    # Returns (True, "") if ffmpeg succeeds, otherwise (False, <error message>).
+    # stderr is only of interest if ffmpeg fails. It goes to an anonymous file
+    # that is read only in that case; unlike an unread pipe, the file cannot
+    # fill up and block ffmpeg however much it writes.
+    try:
+        with tempfile.TemporaryFile() as stderr:
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.DEVNULL,
+                                                        stderr=stderr)
+            await proc.wait()
+            if proc.returncode != 0:
+                stderr.seek(0)
+                return (False, stderr.read().decode('utf8', errors='replace').strip())
+    except OSError as e:
+        return (False, str(e))  # e.g ffmpeg is not installed, or the temp dir is not writable
+    return (True, "")
+
+
+class _FFmpegJob:
+    # A job for _dispatch(), converting src to dst with ffmpeg_conv(). Jobs that
+    # run the ffmpeg executable with the same rule share a batch_key, so that
+    # several of them can be converted by one process with run_batch(). PyAV runs
+    # in-process, so there is no startup to amortize for its jobs.
+    def __init__(self, src, dst, codec, bitrate, threads=None):
+        self.files = (src, dst)
+        self.rule = (codec, bitrate, threads)
+        self.batch_key = self.rule if _pyav_encoder(codec) is None else None
+
+    def __call__(self):
+        return ffmpeg_conv(*self.files, *self.rule)
+
+    @staticmethod
+    def run_batch(jobs):
+        return ffmpeg_conv_batch([job.files for job in jobs], *jobs[0].rule)
+
+    def failed(self, e):
+        # The result for an exception that escaped the conversion
+        src, dst = self.files
+        cmd = ["ffmpeg" if self.batch_key is not None else "pyav"]
+        return {"success": False, "src": src, "dst": dst, "cmd": cmd, "msg": str(e)}
+
+
+# Errors with which the in-kernel copy methods may refuse to work, e.g across
+# filesystems or on older kernels. The next method in turn is tried instead.
+_FAST_COPY_FALLBACK = frozenset((errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTSOCK,
+                                 errno.EOPNOTSUPP, errno.ENOTSUP))
+
+# Upper limit of bytes per single copy_file_range() / sendfile() call
+_FAST_COPY_BLOCKSIZE = 2**30
+
+_thread_local = threading.local()
+
+# Needed on Windows, where os.open() defaults to text mode
+_O_BINARY = getattr(os, "O_BINARY", 0)
+
+
+def _fast_copy_loop(copy):
+    # Call copy(count) until it reports EOF. The size of the file is not relied
+    # on, since the file may have grown after it was stat'ed (or report a bogus
+    # size, like the files in /proc do). Returns False if nothing was copied.
+    copied = False
+    while copy(_FAST_COPY_BLOCKSIZE):
+        copied = True
+    return copied
+
+
+def _copy_file_range(in_fd, out_fd):
+    return _fast_copy_loop(lambda count: os.copy_file_range(in_fd, out_fd, count))
+
+
+def _sendfile(in_fd, out_fd):
+    return _fast_copy_loop(lambda count: os.sendfile(out_fd, in_fd, None, count))
+
+
+def _fcopyfile(in_fd, out_fd):
+    posix._fcopyfile(in_fd, out_fd, posix._COPYFILE_DATA)
+    return True
+
+
+# The in-kernel copy methods available on this platform, in order of preference.
+# On other platforms than Linux, os.sendfile() only supports sockets.
+_FAST_COPIES = [fn for fn, available in [
+    (_copy_file_range, hasattr(os, "copy_file_range")),
+    (_sendfile, hasattr(os, "sendfile") and sys.platform.startswith("linux")),
+    (_fcopyfile, hasattr(posix, "_fcopyfile")),
+] if available]
+
+
+def _readinto_copy(in_fd, out_fd):
+    # The buffer is allocated once per thread, and reused for each file
+    buf = getattr(_thread_local, "copybuf", None)
+    if buf is None:
+        buf = _thread_local.copybuf = memoryview(bytearray(2**20))
+    with open(in_fd, "rb", buffering=0, closefd=False) as fsrc:
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                break
+            view = buf[:n]
+            while view:
+                view = view[os.write(out_fd, view):]
+
+
+def _copyfd(in_fd, out_fd, size):
+    # 'size' is only a hint; whatever it says, the data is copied until EOF. A file
+    # that was empty when stat'ed (or reports a bogus size of 0, like the files in
+    # /proc) goes to the read loop at once, where a single read() finds the EOF.
+    # The in-kernel methods would need a call each to do that.
+    if size:
+        for fast_copy in _FAST_COPIES:
+            try:
+                # Some filesystems (e.g procfs, sysfs) make the in-kernel methods
+                # report EOF at once, without copying anything. The file may still
+                # have data, so the next method has to make sure.
+                if fast_copy(in_fd, out_fd):
+                    return
+            except OSError as e:
+                if e.errno not in _FAST_COPY_FALLBACK:
+                    raise
+            # the next method carries on from the current file offsets
+    _readinto_copy(in_fd, out_fd)
+
+
+def _copyfile(src, dst, st=None):
+    """
+    Copy the data of file src into dst. The bytes are moved in-kernel where possible,
+    trying os.copy_file_range() and os.sendfile() (Linux) and fcopyfile() (macOS),
+    each one falling back to the next if the files or the filesystem do not support
+    it. Finally, a plain read/write loop with a reused buffer is used. Each of them
+    copies until EOF. st is the os.stat_result of src, if the caller has one.
+
+    The files are opened with os.open(); unlike file objects, plain descriptors
+    do not fstat() each file once more when opened.
+    """
+    # Like shutil.copyfile(), refuse special files; e.g opening a named pipe would
+    # block until something writes into it.
+    if st is None:
+        st = os.stat(src)
+    if stat.S_ISFIFO(st.st_mode):
+        raise shutil.SpecialFileError("`{}` is a named pipe".format(src))
+    if not stat.S_ISREG(st.st_mode):
+        raise shutil.SpecialFileError("`{}` is not a regular file".format(src))
+    in_fd = os.open(src, os.O_RDONLY | _O_BINARY)
+    try:
+        out_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY, 0o666)
+        try:
+            _copyfd(in_fd, out_fd, st.st_size)
+        finally:
+            os.close(out_fd)
+    finally:
+        os.close(in_fd)
+
+
+def copyjob(src, dst, entry=None):
+    # 'entry' is the os.DirEntry of src, if the caller happened to have one at hand.
+    # shutil.copystat() accepts it in place of src, and reuses its cached stat
+    # result instead of stat'ing the source again.
+    try:
+        if entry is None:
+            _copyfile(src, dst)
+            shutil.copystat(src, dst)
+        else:
+            _copyfile(src, dst, entry.stat())
+            shutil.copystat(entry, dst)
         msg = None
         ret = True
     except Exception as e:
         ret = False
         msg = str(e)
-    return {"success": ret, "src": src, "dst": dst, "cmd": ["shutil.copy2"], "msg": msg}
+    return {"success": ret, "src": src, "dst": dst, "cmd": ["copyfile"], "msg": msg}
 
 
-# pool, mapfuncs are arguments passed via partial application.
-# the rest follow the signature of shutil.copy & .copy2
-def _mycopy(pool, futures, mapfuncs, src, _dst, *args, verbose=False, **kwargs):
+# In verbose mode every file produces a message or two. Rather than having each
+# thread print its own, they are put in _LOG_Q and written in batches by a single
+# thread; see _background_log().
+_LOG_Q = queue.SimpleQueue()
 
-    dst = pathlib.Path(_dst)
 
-    out_params = mapfuncs.get(dst.suffix.lstrip("."), None)
+def _log(msg):
+    _LOG_Q.put(msg + "\n")
+
+
+def _log_writer():
+    # Write the messages put in _LOG_Q until None is received
+    while True:
+        msgs = [_LOG_Q.get()]
+        while not _LOG_Q.empty():
+            msgs.append(_LOG_Q.get_nowait())
+        sys.stdout.write("".join(m for m in msgs if m is not None))
+        sys.stdout.flush()
+        if None in msgs:
+            return
+
+
+@contextlib.contextmanager
+def _background_log(enabled):
+    # Run _log_writer() for the duration of the block, if enabled. On exit, all
+    # the messages logged inside the block have been written.
+    if not enabled:
+        yield
+        return
+    writer = threading.Thread(target=_log_writer, daemon=True)
+    writer.start()
+    try:
+        yield
+    finally:
+        _LOG_Q.put(None)
+        writer.join()
+
+
+# submit_copy, submit, report, mapfuncs are arguments passed via partial application.
+# the rest are the source and destination paths, plus the os.DirEntry of src
+# (if available) so that its cached metadata can be reused.
+# If precopied is set, the plain files have already been copied by other means
+# (see _robocopy()), and only the ones that are missing are copied here.
+def _mycopy(submit_copy, submit, report, mapfuncs, src, dst, verbose=False,
+            ffmpeg_threads=None, precopied=False, entry=None):
+
+    # Plain string operations; this runs for every file, and constructing
+    # pathlib.Path objects is comparatively slow
+    stem, ext = os.path.splitext(dst)
+
+    out_params = mapfuncs.get(ext[1:], None)
 
     if out_params is not None:
         out_codec   = out_params["codec"]
@@ -79,32 +482,267 @@ def _mycopy(pool, futures, mapfuncs, src, _dst, *args, verbose=False, **kwargs):
         out_bitrate = out_params["bitrate"]
 
         # Will crash if no such codec exists. This is intended behaviour
-        newdest = str(pathlib.Path(dst).with_suffix("." + out_ext))
+        newdest = stem + "." + out_ext
 
         if verbose:
-            print(">> [CONV] '{0}' -> '{1}'".format(src, newdest))
+            _log(">> [CONV] '{0}' -> '{1}'".format(src, newdest))
 
-        fut = pool.submit(ffmpeg_conv, src, newdest, out_codec, out_bitrate)
-        futures.append(fut)
+        submit(_FFmpegJob(src, newdest, out_codec, out_bitrate, threads=ffmpeg_threads))
         return newdest
 
     else:
+        if precopied and os.path.lexists(dst):
+            report({"success": True, "src": src, "dst": dst, "cmd": ["robocopy"], "msg": None})
+            return
         if verbose:
-            print(">> [COPY] '{0}' -> '{1}'".format(src, dst))
-        fut = pool.submit(copyjob, src, dst, *args, **kwargs)
-        futures.append(fut)
+            _log(">> [COPY] '{0}' -> '{1}'".format(src, dst))
+        fut = submit_copy(copyjob, src, dst, entry=entry)
+        fut.add_done_callback(lambda f: report(f.result()))
+
+
+def _bounded_submit(pool, inflight, fn, *args, **kwargs):
+    # pool.submit(), but block while the semaphore 'inflight' has no slots left
+    # for yet another pending job
+    inflight.acquire()
+    fut = pool.submit(fn, *args, **kwargs)
+    fut.add_done_callback(lambda _: inflight.release())
+    return fut
+
+
+def _walk(indir, outdir, ignore, copy_function, workers=1, exist_ok=False):
+    """
+    Replicate the directory tree indir into outdir, passing each file to
+    copy_function. Names matching ignore(path, names) are skipped. If exist_ok
+    is False, outdir must not exist yet.
+
+    The directories are listed with os.scandir() by 'workers' threads in parallel,
+    so that the latency of reading one directory overlaps with reading others.
+    The file type and stat information cached in each os.DirEntry is reused
+    instead of being queried again for every path. Each output directory is created
+    before any of its contents are handed to copy_function, so the files can be
+    processed in any order.
+
+    outdir may reside inside indir; it is skipped when it is come across.
+
+    Returns a list of the (source, destination) directory pairs, parents before
+    their children. If listing or creating any directory fails, the first such
+    error is raised after the rest of the tree has been processed.
+    """
+    dirs = [(indir, outdir)]
+    errors = []
+    todo = queue.Queue()
+    skip = os.path.normcase(os.path.abspath(outdir))
 
+    def scan(src_dir, dst_dir):
+        with os.scandir(src_dir) as it:
+            entries = list(it)
 
-# e.g 'flac:libmp3lame:ogg:128k' -> ('flac', 'libmp3lam3', '128k')
-_PATT = re.compile(r"([a-zA-Z0-9]+):([a-zA-Z0-9]+):([a-zA-Z0-9]+):(\d+k)")
+        if src_dir == indir:
+            os.makedirs(dst_dir, exist_ok=exist_ok)
 
+        ignored_names = ignore(src_dir, [entry.name for entry in entries])
 
+        for entry in entries:
+            if entry.name in ignored_names:
+                continue
+            dst = os.path.join(dst_dir, entry.name)
+            # like copytree(symlinks=False), symlinked directories are followed
+            if entry.is_dir():
+                if os.path.normcase(os.path.abspath(entry.path)) == skip:
+                    continue
+                try:
+                    os.mkdir(dst)
+                except FileExistsError:
+                    if not exist_ok:
+                        raise
+                dirs.append((entry.path, dst))
+                todo.put((entry.path, dst))
+            else:
+                copy_function(entry.path, dst, entry=entry)
+
+    def worker():
+        while True:
+            item = todo.get()
+            if item is None:
+                return
+            try:
+                scan(*item)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                todo.task_done()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for t in threads:
+        t.start()
+
+    todo.put((indir, outdir))
+    todo.join()
+
+    for _ in threads:
+        todo.put(None)
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+    return dirs
+
+
+_GLOB_MAGIC = re.compile(r"[*?[]")
+
+
+def _robocopy_cmd(indir, outdir, exclude_files, exclude_dirs, threads):
+    # By default robocopy retries a failed file a million times, 30 seconds apart.
+    # Here it gives up at once; the missing file is then copied (or its failure
+    # reported) by copyjob().
+    cmd = ["robocopy", os.path.normpath(indir), os.path.normpath(outdir),
+           "/E", "/MT:{}".format(max(1, min(128, threads))), "/R:0", "/W:0",
+           "/NP", "/NFL", "/NDL", "/NJH", "/NJS"]
+    if exclude_files:
+        cmd += ["/XF", *exclude_files]
+    if exclude_dirs:
+        cmd += ["/XD", *exclude_dirs]
+    return cmd
+
+
+def _robocopy(indir, outdir, exclude_files, exclude_dirs, threads):
+    """
+    Copy the directory tree indir into outdir with robocopy (Windows only), using
+    'threads' parallel copy threads. Files and directories matching the wildcard
+    patterns in exclude_files and exclude_dirs are left out.
+
+    Returns True on success, False if robocopy is not available or it failed.
+    """
+    cmd = _robocopy_cmd(indir, outdir, exclude_files, exclude_dirs, threads)
+    warn = "WARNING: robocopy failed, copying the files one by one instead: {}"
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+        print(warn.format(e), file=sys.stderr)
+        return False
+    # exit codes below 8 are various kinds of success, 8 and above mean failures
+    if proc.returncode >= 8:
+        print(warn.format(proc.stdout.decode(errors='replace').strip()), file=sys.stderr)
+        return False
+    return True
+
+
+def _make_ignore(patts):
+    """
+    Like shutil.ignore_patterns(*patts), but the glob patterns are translated and
+    compiled into a single regular expression once, so that each name is matched
+    with one regex call instead of running fnmatch.filter() per pattern per directory.
+    Patterns without any wildcards (e.g 'Thumbs.db') are matched with a set lookup.
+    """
+    # fnmatch normalizes case on case-insensitive platforms (i.e Windows); there
+    # every pattern goes to the regex, which then ignores case.
+    nocase = os.path.normcase("A") != "A"
+
+    literals = set() if nocase else {p for p in patts if not _GLOB_MAGIC.search(p)}
+    globs = [p for p in patts if p not in literals]
+
+    if not globs:
+        return lambda path, names: literals.intersection(names)
+
+    combined = re.compile("(?:" + ")|(?:".join(fnmatch.translate(p) for p in globs) + ")",
+                          re.IGNORECASE if nocase else 0)
+    match = combined.match
+
+    def ignore(path, names):
+        return {n for n in names if n in literals or match(n)}
+
+    return ignore
+
+
+async def _dispatch(walk, concurrency, report, max_batch=1):
+    """
+    Run walk(submit, report) in a separate thread, while 'concurrency' worker
+    coroutines execute the jobs that walk passes to submit(). A job is a callable
+    returning an awaitable; report() is called with the result of each job as it
+    finishes. walk may also pass results of work it did itself to report().
+    report() is always called in the event loop thread. If a job raises an
+    exception, job.failed(exception) is reported instead of its result.
+
+    A job may have a 'batch_key' other than None. A worker then takes along up to
+    max_batch - 1 of the following queued jobs with the same key, and runs them
+    all with job.run_batch(jobs), which returns an awaitable list of results.
+
+    Only a few jobs per worker are queued at a time; submit() blocks the walk
+    until there is room, so the traversal cannot run arbitrarily far ahead.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=concurrency * 4)
+
+    def submit(job):
+        asyncio.run_coroutine_threadsafe(queue.put(job), loop).result()
+
+    def report_threadsafe(res):
+        loop.call_soon_threadsafe(report, res)
+
+    async def worker():
+        held = []  # a job taken from the queue that did not fit in the last batch
+        while True:
+            job = held.pop() if held else await queue.get()
+            if job is None:
+                return
+            batch = [job]
+            key = getattr(job, "batch_key", None)
+            # Leave enough queued jobs for the other workers to stay busy
+            limit = min(max_batch, 1 + queue.qsize() // concurrency) if key is not None else 1
+            while len(batch) < limit and not queue.empty():
+                nxt = queue.get_nowait()
+                if nxt is None or getattr(nxt, "batch_key", None) != key:
+                    held.append(nxt)
+                    break
+                batch.append(nxt)
+            try:
+                results = [await job()] if len(batch) == 1 else await job.run_batch(batch)
+            except Exception as e:
+                # The worker must live on; if all of them died, submit() would
+                # block the walk forever.
+                results = [j.failed(e) for j in batch]
+            for res in results:
+                report(res)
+
+    workers = [loop.create_task(worker()) for _ in range(concurrency)]
+
+    try:
+        await loop.run_in_executor(None, walk, submit, report_threadsafe)
+    finally:
+        for _ in workers:
+            await queue.put(None)
+
+    await asyncio.gather(*workers)
+
+
+def _isalnum(s):
+    return s.isascii() and s.isalnum()
+
+
+# e.g 'flac:libmp3lame:ogg:128k' -> ('flac', {'codec': 'libmp3lame', 'ext': 'ogg', ...})
 def parse_ffmpeg_rule(rule):
-    parsed = _PATT.findall(rule)
-    if not parsed:
+    parts = rule.split(":")
+    if len(parts) != 4:
+        return None
+    ext_in, codec, ext_out, bitrate = parts
+    if not (bitrate.endswith("k") and bitrate[:-1].isascii() and bitrate[:-1].isdigit()):
+        return None
+    if not all(_isalnum(p) for p in (ext_in, codec, ext_out)):
         return None
-    vals = parsed[0]
-    return vals[0], {"codec": vals[1], "ext": vals[2], "bitrate": vals[3]}
+    return ext_in, {"codec": codec, "ext": ext_out, "bitrate": bitrate}
+
+
+def _ffmpeg_threads(value):
+    try:
+        threads = int(value)
+    except ValueError:
+        threads = 0
+    if not 1 <= threads <= 64:
+        raise argparse.ArgumentTypeError("expected an integer in range [1, 64], "
+                                         "got '{}'".format(value))
+    return threads
 
 
 class FFMPEGRuleAction(argparse.Action):
@@ -128,6 +766,16 @@ class FFMPEGRuleAction(argparse.Action):
         setattr(namespace, self.dest, newdict)
 
 
+class UniqueAppendAction(argparse.Action):
+    """
+    Like action='append', but a value given multiple times is stored only once.
+    """
+    def __call__(self, parser, namespace, values, option_string=None):
+        existing = getattr(namespace, self.dest, None) or []
+        # dict preserves insertion order, so the first occurrence wins
+        setattr(namespace, self.dest, list(dict.fromkeys([*existing, values])))
+
+
 def parse_args(argv):
     """
     Parse list of strings into argparse.Namespace()
@@ -176,7 +824,7 @@ def parse_args(argv):
                    help="Input directory. Files in this directory are not modified.")
     p.add_argument("--outdir", required=True,
                    help="Output directory. Files from INDIR are copied or mapped here")
-    p.add_argument("--ignore", action='append',
+    p.add_argument("--ignore", action=UniqueAppendAction,
                    help=("Neither copy nor map files with these extensions. "
                          "Glob-pattern aware. For example: --ignore '*.jpg'"))
     p.add_argument("--ffmpeg", nargs='+', action=FFMPEGRuleAction, metavar='FFMPEG_RULE',
@@ -184,6 +832,9 @@ def parse_args(argv):
                          "See FFMPEG_RULE description below"))
     p.add_argument("--concurrency", default=cpu_count(), metavar='NJOBS', type=int,
                    help="Number of parallel workers to use. Default value == available cpu count.")
+    p.add_argument("--ffmpeg-threads", metavar='NTHREADS', type=_ffmpeg_threads,
+                   help=("Number of threads each ffmpeg process may use, in range [1, 64]. "
+                         "Default value == available cpu count divided by NJOBS."))
     p.add_argument("--verbose", help="Be more verbose", action='store_true')
 
     args = p.parse_args(argv[1:])
@@ -191,7 +842,8 @@ def parse_args(argv):
     return args
 
 
-def _main(indir, outdir, ffmpeg_map=None, ignore_patts=None, concurrency=1, verbose=False):
+def _main(indir, outdir, ffmpeg_map=None, ignore_patts=None, concurrency=1, verbose=False,
+          ffmpeg_threads=None):
     """
     Main function of copy-tree-map
 
@@ -212,68 +864,105 @@ def _main(indir, outdir, ffmpeg_map=None, ignore_patts=None, concurrency=1, verb
         List of strings; glob-patterns of input files which to ignore.
     concurrency
         Number of parallel workers to use
+    ffmpeg_threads
+        Number of threads each ffmpeg process may use. By default the available cpus
+        are divided evenly between the parallel workers, so that the concurrently
+        running ffmpeg processes do not oversubscribe the cpus.
     """
     indir = str(indir)
     outdir = str(outdir)
     ffmpeg_map = ffmpeg_map or {}
     ignore_patts = ignore_patts or []
     concurrency = max(1, concurrency)
+    ffmpeg_threads = ffmpeg_threads or max(1, cpu_count() // concurrency)
 
-    ignored = []
-    futures = []
+    n_ign = 0
+    n_ign_lock = threading.Lock()
+    n_done = 0
     failed = []
+    dirs = []
+
+    # Plain copies are I/O bound and get a thread pool of their own, sized for
+    # I/O parallelism. That way quick copies are not held up behind long
+    # transcodes, which have 'concurrency' workers of their own.
+    copy_workers = min(32, cpu_count() * 4)
+
+    # On Windows, robocopy is much faster than copying the files one by one. It is
+    # used for copying everything except the files to be transcoded, which are then
+    # handled below. robocopy wildcards only support '*' and '?', though.
+    use_robocopy = sys.platform == "win32" and not any("[" in p for p in ignore_patts)
+    precopied = False
+    if use_robocopy:
+        if os.path.lexists(outdir):
+            print("ERROR - File or directory already exists: '{}'".format(outdir))
+            return -2
+        exclude_files = [*ignore_patts, *("*." + ext for ext in ffmpeg_map)]
+        # outdir is excluded in case it resides inside indir
+        exclude_dirs = [*ignore_patts, os.path.abspath(outdir)]
+        precopied = _robocopy(indir, outdir, exclude_files, exclude_dirs, copy_workers)
 
-    # Construct the ignore_patterns object object for shutil.copytree()
-    ign_patts = shutil.ignore_patterns(*ignore_patts)
+    # Construct the ignore function for _walk()
+    ign_patts = _make_ignore(ignore_patts)
 
-    # Helper function that captures filenames that are ignored by shutil.copytree
+    # Helper function that captures filenames that are ignored by _walk
     # Not really needed, except for debugging in verbose mode
     def ignorefn(*fooargs, **fookwargs):
+        nonlocal n_ign
         ret = ign_patts(*fooargs, **fookwargs)
         if ret:
-            ign = list(ret)
             if verbose:
-                print(">> [IGNR] '{}'".format(', '.join(f for f in ign)))
-            ignored.extend(ign)
+                _log(">> [IGNR] '{}'".format(', '.join(f for f in ret)))
+            with n_ign_lock:
+                n_ign += len(ret)
         return ret
 
-    # Uh... we are running subprocesses inside the threads...?
-    # The threads don't do much, just wait for the subprocess to finish :)
-    # TODO: use asyncio or something...
-    with ThreadPoolExecutor(max_workers=concurrency) as pool:
-
-        # Produce a function with the appropriate copy_function signature
-        # that copytree() expects
-        mycopy = functools.partial(_mycopy, pool, futures,
-                                   ffmpeg_map, verbose=verbose)
-
-        try:
-            shutil.copytree(indir, outdir, ignore=ignorefn, copy_function=mycopy)
-        except FileExistsError as e:
-            print("ERROR - File or directory already exists: '{}'".format(e.filename))
-            return -2
-
+    # Only the failed results are kept, the rest are just counted
+    def report(res):
+        nonlocal n_done
+        n_done += 1
         if verbose:
-            print("---")
+            status = ["FAILURE", "SUCCESS"][res["success"]]
+            _log("<< [{}] {} -> {}".format(status, res["src"], res["dst"]))
+        if res["success"]:
+            return
+        failed.append(res)
+        warn = "WARNING: the operation '{}' from '{}' to '{}' failed: {}"
+        print(warn.format(res["cmd"][0], res["src"], res["dst"], res["msg"]), file=sys.stderr)
+
+    def walk(submit, report):
+        with ThreadPoolExecutor(max_workers=copy_workers) as copy_pool:
+            # Bound the number of pending copies, so that memory use depends on
+            # the number of workers instead of the size of the tree.
+            submit_copy = functools.partial(_bounded_submit, copy_pool,
+                                            threading.Semaphore(copy_workers * 4))
+            # Produce a function with the appropriate copy_function signature
+            # that _walk() expects
+            mycopy = functools.partial(_mycopy, submit_copy, submit, report, ffmpeg_map,
+                                       verbose=verbose, ffmpeg_threads=ffmpeg_threads,
+                                       precopied=precopied)
+            # After robocopy (even a failed one) outdir may already exist
+            dirs.extend(_walk(indir, outdir, ignorefn, mycopy,
+                              workers=min(16, cpu_count() * 2), exist_ok=use_robocopy))
+
+    # The tree is walked by threads that also feed the copy pool, while the ffmpeg
+    # processes are run and waited for by worker coroutines in the event loop.
+    try:
+        with _background_log(verbose):
+            asyncio.run(_dispatch(walk, concurrency, report, max_batch=_FFMPEG_BATCH))
+    except FileExistsError as e:
+        print("ERROR - File or directory already exists: '{}'".format(e.filename))
+        return -2
 
-        for fut in as_completed(futures):
-            res = fut.result()
-            if verbose:
-                status = ["FAILURE", "SUCCESS"][res["success"]]
-                print("<< [{}] {} -> {}".format(status, res["src"], res["dst"]))
-            if res["success"]:
-                continue
-            failed.append(res)
-            warn = "WARNING: the operation '{}' from '{}' to '{}' failed: {}"
-            print(warn.format(res["cmd"][0], res["src"], res["dst"], res["msg"]), file=sys.stderr)
+    # Only now that nothing is written into the directories anymore, their
+    # timestamps and permissions can be copied (children first).
+    for src_dir, dst_dir in reversed(dirs):
+        shutil.copystat(src_dir, dst_dir)
 
-        if verbose:
-            print("---")
+    if verbose:
+        print("---")
 
-    n_futs = len(futures)
-    n_ign  = len(ignored)
     n_fail = len(failed)
-    n_tot  = n_futs + n_ign
+    n_tot  = n_done + n_ign
     n_ok   = n_tot - n_fail  - n_ign
 
     if n_fail > 0:
@@ -288,7 +977,8 @@ def _main(indir, outdir, ffmpeg_map=None, ignore_patts=None, concurrency=1, verb
 def main():
     args = parse_args(sys.argv)
     sys.exit(_main(args.indir, args.outdir, ignore_patts=args.ignore, ffmpeg_map=args.ffmpeg,
-                   concurrency=args.concurrency, verbose=args.verbose))
+                   concurrency=args.concurrency, verbose=args.verbose,
+                   ffmpeg_threads=args.ffmpeg_threads))
 
 
 if __name__ == "__main__":
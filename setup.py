@@ -13,6 +13,9 @@ extras_require = {
         'pytest',
         'pytest-cov',
         'pytest-flake8'
+    ],
+    'pyav': [
+        'av'
     ]
 }
 
@@ -34,7 +37,7 @@ if __name__ == "__main__":
                 'copy-tree-map=copy_tree_map:main'
             }
         },
-        python_requires='>=3.5, <4',
+        python_requires='>=3.8, <4',
         install_requires=requirements,
         extras_require=extras_require,
         project_urls={
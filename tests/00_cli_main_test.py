@@ -1,6 +1,9 @@
-from copy_tree_map import _main
+from copy_tree_map import _main, copyjob
+import os
 import pathlib
+import pytest
 import sys
+import threading
 
 here = pathlib.Path(__file__).parent.resolve()
 
@@ -9,6 +12,7 @@ here = pathlib.Path(__file__).parent.resolve()
 # the correct permissons (chmod a-rwx)
 cantread = pathlib.Path(here / 'example' / 'foo' / 'cantread')
 cantread.touch(mode=0, exist_ok=True)
+cantread.chmod(0)  # touch() leaves the mode of an existing file as it is
 
 # TODO: refactor the code for easier testing
 
@@ -84,3 +88,43 @@ def test_main_witherror(tmp_path):
     assert ret == -1 # success, but there were errors
 
 
+def test_main_copy_preserves_content_and_stat(tmp_path):
+    indir = (here / 'example')
+    ignore = ["*cantread*"]
+    tmp_path.rmdir()
+    ret = _main(indir, tmp_path, ignore_patts=ignore, concurrency=1)
+    assert ret == 0
+
+    for name in ["beep.flac", "foo/beep.m4a", "bar/hello2-noignore.txt"]:
+        src, dst = (indir / name), (tmp_path / name)
+        assert src.read_bytes() == dst.read_bytes()
+        assert src.stat().st_mode == dst.stat().st_mode
+        assert src.stat().st_mtime_ns == dst.stat().st_mtime_ns
+
+
+def test_copyjob_copies_until_eof(tmp_path):
+    # the file grows after its DirEntry has cached the stat result
+    src = tmp_path / "growing"
+    src.write_bytes(b"0123456789")
+    entry = next(os.scandir(tmp_path))
+    entry.stat()
+    with open(src, "ab") as f:
+        f.write(b"abcdefghij")
+    res = copyjob(str(src), str(tmp_path / "copy"), entry=entry)
+    assert res["success"]
+    assert (tmp_path / "copy").read_bytes() == b"0123456789abcdefghij"
+
+
+@pytest.mark.skipif(not hasattr(os, "mkfifo"), reason="no named pipes")
+def test_copyjob_rejects_named_pipe(tmp_path):
+    os.mkfifo(tmp_path / "pipe")
+    entry = next(os.scandir(tmp_path))
+    results = []
+    # a daemon thread, so that a copy blocked on the pipe fails the test
+    # instead of hanging it
+    t = threading.Thread(target=lambda: results.append(
+        copyjob(entry.path, str(tmp_path / "copy"), entry=entry)), daemon=True)
+    t.start()
+    t.join(timeout=10)
+    assert results and not results[0]["success"]
+    assert "is a named pipe" in results[0]["msg"]
@@ -0,0 +1,17 @@
+from copy_tree_map import _make_ignore, parse_args
+import shutil
+
+names = ["foo.txt", "foo.TXT", "bar.md", "notouchme", "x-notouchme-y", "baz.flac", "[a].jpg"]
+
+
+def test_make_ignore_matches_shutil_ignore_patterns():
+    for patts in [[], ["*.txt"], ["*.md", "*notouchme*"], ["[[]a]*", "ba?.*"],
+                  ["notouchme"], ["notouchme", "*.flac", "foo.txt"]]:
+        expected = shutil.ignore_patterns(*patts)("somedir", names)
+        assert _make_ignore(patts)("somedir", names) == set(expected)
+
+
+def test_parse_args_ignore_deduplicated():
+    argv = ["copy-tree-map", "--indir", "in", "--outdir", "out",
+            "--ignore", "*.md", "--ignore", "*.txt", "--ignore", "*.md"]
+    assert parse_args(argv).ignore == ["*.md", "*.txt"]
@@ -0,0 +1,16 @@
+from copy_tree_map import parse_ffmpeg_rule
+
+
+def test_parse_ffmpeg_rule_valid():
+    assert parse_ffmpeg_rule("flac:libopus:ogg:192k") == \
+        ("flac", {"codec": "libopus", "ext": "ogg", "bitrate": "192k"})
+    assert parse_ffmpeg_rule("wav:libmp3lame:mp3:128k") == \
+        ("wav", {"codec": "libmp3lame", "ext": "mp3", "bitrate": "128k"})
+
+
+def test_parse_ffmpeg_rule_invalid():
+    for rule in ["", "flac", "flac:libopus:ogg", "flac:libopus:ogg:192",
+                 "flac:libopus:ogg:k", "flac:libopus:ogg:192kk", "flac:lib-opus:ogg:192k",
+                 "flac::ogg:192k", "flac:libopus:ogg:192k:extra", "flac:libopus:ögg:192k",
+                 "flac:libopus:ogg:１92k"]:
+        assert parse_ffmpeg_rule(rule) is None, rule
@@ -0,0 +1,54 @@
+import copy_tree_map
+from copy_tree_map import _robocopy_cmd
+import os
+import sys
+
+
+def test_robocopy_cmd():
+    cmd = _robocopy_cmd("in", "out", ["*.md", "*.flac"], ["*.md"], threads=8)
+    assert cmd[:3] == ["robocopy", "in", "out"]
+    assert "/E" in cmd and "/MT:8" in cmd
+    assert "/R:0" in cmd and "/W:0" in cmd
+    assert cmd[cmd.index("/XF") + 1:cmd.index("/XD")] == ["*.md", "*.flac"]
+    assert cmd[cmd.index("/XD") + 1:] == ["*.md"]
+
+
+def test_robocopy_cmd_no_excludes():
+    cmd = _robocopy_cmd("in" + os.sep, "out", [], [], threads=1000)
+    assert cmd[1] == "in"
+    assert "/MT:128" in cmd
+    assert "/XF" not in cmd and "/XD" not in cmd
+
+
+def _tree(indir):
+    (indir / "sub").mkdir(parents=True)
+    (indir / "a.txt").write_text("a")
+    (indir / "sub" / "b.txt").write_text("b")
+
+
+def test_main_outdir_inside_indir(tmp_path):
+    indir = tmp_path / "in"
+    _tree(indir)
+    outdir = indir / "sub" / "out"
+    assert copy_tree_map._main(indir, outdir) == 0
+    assert (outdir / "a.txt").read_text() == "a"
+    assert (outdir / "sub" / "b.txt").read_text() == "b"
+    assert not (outdir / "sub" / "out").exists()
+
+
+def test_main_robocopy_outdir_inside_indir(tmp_path, monkeypatch):
+    # robocopy creates outdir before the tree is walked; here it then fails, so
+    # that the files are left for copyjob()
+    def fake_robocopy(indir, outdir, exclude_files, exclude_dirs, threads):
+        os.makedirs(outdir)
+        return False
+    monkeypatch.setattr(sys, "platform", "win32")
+    monkeypatch.setattr(copy_tree_map, "_robocopy", fake_robocopy)
+
+    indir = tmp_path / "in"
+    _tree(indir)
+    outdir = indir / "out"
+    assert copy_tree_map._main(indir, outdir) == 0
+    assert (outdir / "a.txt").read_text() == "a"
+    assert (outdir / "sub" / "b.txt").read_text() == "b"
+    assert not (outdir / "out").exists()
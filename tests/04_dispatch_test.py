@@ -0,0 +1,31 @@
+from copy_tree_map import _dispatch
+import asyncio
+
+
+class Job:
+    batch_key = None
+
+    def __init__(self, i):
+        self.i = i
+
+    async def __call__(self):
+        if self.i == 0:
+            raise OSError("job 0 failed")
+        return {"success": True, "src": self.i}
+
+    def failed(self, e):
+        return {"success": False, "src": self.i, "msg": str(e)}
+
+
+def test_dispatch_reports_failing_job():
+    results = []
+
+    def walk(submit, report):
+        for i in range(3):
+            submit(Job(i))
+
+    asyncio.run(_dispatch(walk, 1, results.append))
+
+    assert sorted(r["src"] for r in results) == [0, 1, 2]
+    assert [r for r in results if not r["success"]] == [
+        {"success": False, "src": 0, "msg": "job 0 failed"}]
@@ -0,0 +1,86 @@
+import copy_tree_map
+from copy_tree_map import _main, ffmpeg_conv_batch
+import asyncio
+import os
+import pathlib
+import shutil
+
+here = pathlib.Path(__file__).parent.resolve()
+beep = here / 'example' / 'beep.flac'
+
+
+def _tree(path, names):
+    path.mkdir()
+    for name in names:
+        shutil.copyfile(beep, path / name)
+
+
+def test_ffmpeg_conv_batch_same_output(tmp_path):
+    indir = tmp_path / "in"
+    _tree(indir, ["a.flac", "a.wav", "b.flac", "c.flac"])
+    jobs = [(str(indir / src), str(tmp_path / dst))
+            for src, dst in [("a.flac", "a.ogg"), ("a.wav", "a.ogg"),
+                             ("b.flac", "b.ogg"), ("c.flac", "c.ogg")]]
+    results = asyncio.run(ffmpeg_conv_batch(jobs, "libopus", "64k"))
+
+    assert sorted((r["src"], r["success"]) for r in results) == sorted([
+        (jobs[0][0], True), (jobs[1][0], False), (jobs[2][0], True), (jobs[3][0], True)])
+    # the same input everywhere, so the outputs must be alike (the random ogg
+    # stream serial numbers aside)
+    sizes = [(tmp_path / name).stat().st_size for name in ["a.ogg", "b.ogg", "c.ogg"]]
+    assert sizes[0] > 0 and sizes.count(sizes[0]) == 3
+
+
+def test_main_ffmpeg_conv_without_pyav(tmp_path, monkeypatch):
+    monkeypatch.setattr(copy_tree_map, "_pyav_encoder", lambda codec: None)
+    indir, outdir = tmp_path / "in", tmp_path / "out"
+    _tree(indir, ["a.flac", "a.wav", "b.flac", "c.flac", "d.flac", "e.flac"])
+    rule = {"codec": "libopus", "ext": "ogg", "bitrate": "64k"}
+    ret = _main(indir, outdir, ffmpeg_map={"flac": rule, "wav": rule}, concurrency=1)
+    assert ret == -1  # one of a.flac and a.wav cannot be converted to a.ogg
+
+    sizes = [(outdir / (name + ".ogg")).stat().st_size for name in "abcde"]
+    assert sizes[0] > 0 and sizes.count(sizes[0]) == 5
+
+
+def _batch_meanwhile(tmp_path, monkeypatch, names, appears, broken=None):
+    # Run ffmpeg_conv_batch() on names, while the output 'appears' is created by
+    # someone else just before ffmpeg starts. 'broken' is an input that is not audio.
+    indir, outdir = tmp_path / "in", tmp_path / "out"
+    _tree(indir, names)
+    if broken:
+        (indir / broken).write_bytes(b"not audio")
+    outdir.mkdir()
+    real_run = copy_tree_map._run_ffmpeg
+
+    async def run(cmd):
+        if not (outdir / appears).exists():
+            (outdir / appears).write_bytes(b"keep")
+        return await real_run(cmd)
+    monkeypatch.setattr(copy_tree_map, "_run_ffmpeg", run)
+
+    jobs = [(str(indir / name), str(outdir / (name.split(".")[0] + ".ogg"))) for name in names]
+    results = asyncio.run(ffmpeg_conv_batch(jobs, "libopus", "64k"))
+    return outdir, {pathlib.Path(r["dst"]).name: r for r in results}
+
+
+def test_ffmpeg_conv_batch_output_appears_meanwhile(tmp_path, monkeypatch):
+    outdir, results = _batch_meanwhile(tmp_path, monkeypatch,
+                                       ["a.flac", "b.flac", "c.flac"], "a.ogg")
+    assert not results["a.ogg"]["success"]
+    assert "already exists" in results["a.ogg"]["msg"]
+    assert results["b.ogg"]["success"] and results["c.ogg"]["success"]
+    assert (outdir / "a.ogg").read_bytes() == b"keep"
+    assert (outdir / "b.ogg").stat().st_size == (outdir / "c.ogg").stat().st_size > 0
+    assert sorted(os.listdir(outdir)) == ["a.ogg", "b.ogg", "c.ogg"]  # no leftovers
+
+
+def test_ffmpeg_conv_batch_failure_keeps_others_files(tmp_path, monkeypatch):
+    # the batch fails because of x.flac; c.ogg, created meanwhile, must survive that
+    outdir, results = _batch_meanwhile(tmp_path, monkeypatch,
+                                       ["a.flac", "b.flac", "c.flac", "x.flac"], "c.ogg",
+                                       broken="x.flac")
+    assert results["a.ogg"]["success"] and results["b.ogg"]["success"]
+    assert not results["c.ogg"]["success"] and not results["x.ogg"]["success"]
+    assert (outdir / "c.ogg").read_bytes() == b"keep"
+    assert sorted(os.listdir(outdir)) == ["a.ogg", "b.ogg", "c.ogg"]
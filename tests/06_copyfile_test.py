@@ -0,0 +1,114 @@
+import copy_tree_map
+from copy_tree_map import _copyfile
+import errno
+import os
+import pytest
+import sys
+
+# the real one, for the fakes that copy part of the data
+_real_copy_file_range = getattr(os, "copy_file_range", None)
+
+
+def test_copyfile_empty_goes_to_read_loop(tmp_path, monkeypatch):
+    def fail(in_fd, out_fd):
+        raise AssertionError("in-kernel copy used for an empty file")
+    monkeypatch.setattr(copy_tree_map, "_FAST_COPIES", [fail])
+
+    src = tmp_path / "src"
+    src.write_bytes(b"")
+    st = os.stat(src)
+    _copyfile(str(src), str(tmp_path / "empty"), st)
+    assert (tmp_path / "empty").read_bytes() == b""
+
+    # the size is only a hint; a file that grew after the stat is copied whole
+    src.write_bytes(b"grown")
+    _copyfile(str(src), str(tmp_path / "grown"), st)
+    assert (tmp_path / "grown").read_bytes() == b"grown"
+
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith("linux"),
+                                reason="copy_file_range and sendfile on files need Linux")
+
+
+def _copy_with(tmp_path, monkeypatch, copy_file_range=None, sendfile=None):
+    # Copy a 3 MiB file with _copyfile(), with os.copy_file_range() and os.sendfile()
+    # replaced by the given functions (if any); returns the names of the methods
+    # called, in order.
+    calls = []
+    real = {"copy_file_range": os.copy_file_range, "sendfile": os.sendfile}
+    fakes = {"copy_file_range": copy_file_range, "sendfile": sendfile}
+    for name, fake in fakes.items():
+        def wrapper(*args, name=name, fake=fake):
+            calls.append(name)
+            return (fake or real[name])(*args)
+        monkeypatch.setattr(os, name, wrapper)
+    real_readinto = copy_tree_map._readinto_copy
+
+    def readinto(*args):
+        calls.append("readinto")
+        return real_readinto(*args)
+    monkeypatch.setattr(copy_tree_map, "_readinto_copy", readinto)
+    monkeypatch.setattr(copy_tree_map, "_FAST_COPIES",
+                        [copy_tree_map._copy_file_range, copy_tree_map._sendfile])
+
+    data = os.urandom(3 * 2**20 + 123)
+    (tmp_path / "src").write_bytes(data)
+    _copyfile(str(tmp_path / "src"), str(tmp_path / "dst"))
+    assert (tmp_path / "dst").read_bytes() == data
+    return calls
+
+
+def _raise(err):
+    def fn(*args):
+        raise OSError(err, os.strerror(err))
+    return fn
+
+
+@linux_only
+def test_copyfile_copy_file_range(tmp_path, monkeypatch):
+    calls = _copy_with(tmp_path, monkeypatch)
+    assert set(calls) == {"copy_file_range"}
+
+
+@linux_only
+@pytest.mark.parametrize("err", [errno.EXDEV, errno.ENOSYS])
+def test_copyfile_falls_back_to_sendfile(tmp_path, monkeypatch, err):
+    calls = _copy_with(tmp_path, monkeypatch, copy_file_range=_raise(err))
+    assert calls[0] == "copy_file_range" and set(calls[1:]) == {"sendfile"}
+
+
+@linux_only
+def test_copyfile_falls_back_to_read_loop(tmp_path, monkeypatch):
+    calls = _copy_with(tmp_path, monkeypatch, copy_file_range=_raise(errno.EXDEV),
+                       sendfile=_raise(errno.EINVAL))
+    assert calls == ["copy_file_range", "sendfile", "readinto"]
+
+
+@linux_only
+def test_copyfile_falls_back_when_nothing_copied(tmp_path, monkeypatch):
+    # e.g procfs, where copy_file_range() reports EOF at once
+    calls = _copy_with(tmp_path, monkeypatch, copy_file_range=lambda *args: 0,
+                       sendfile=lambda *args: 0)
+    assert calls == ["copy_file_range", "sendfile", "readinto"]
+
+
+@linux_only
+def test_copyfile_falls_back_mid_file(tmp_path, monkeypatch):
+    # the next method carries on from where the previous one gave up
+    state = {"calls": 0}
+
+    def flaky(in_fd, out_fd, count):
+        state["calls"] += 1
+        if state["calls"] > 1:
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        return _real_copy_file_range(in_fd, out_fd, 2**20)
+    calls = _copy_with(tmp_path, monkeypatch, copy_file_range=flaky)
+    assert calls[:2] == ["copy_file_range", "copy_file_range"]
+    assert set(calls[2:]) == {"sendfile"}
+
+
+@linux_only
+def test_copyfile_other_errors_propagate(tmp_path, monkeypatch):
+    with pytest.raises(OSError) as e:
+        _copy_with(tmp_path, monkeypatch, copy_file_range=_raise(errno.EIO))
+    assert e.value.errno == errno.EIO
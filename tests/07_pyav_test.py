@@ -0,0 +1,41 @@
+from copy_tree_map import ffmpeg_conv
+import asyncio
+import pytest
+
+av = pytest.importorskip("av")
+
+
+def _silence(path, layout, rate=44100, frames=20):
+    # a short FLAC file of silence with the given channel layout
+    with av.open(str(path), "w") as out:
+        stream = out.add_stream("flac", rate=rate, layout=layout)
+        for i in range(frames):
+            frame = av.AudioFrame(format="s16", layout=layout, samples=1024)
+            frame.planes[0].update(bytes(frame.planes[0].buffer_size))
+            frame.rate = rate
+            frame.pts = i * 1024
+            for packet in stream.encode(frame):
+                out.mux(packet)
+        for packet in stream.encode(None):
+            out.mux(packet)
+
+
+def _convert(tmp_path, layout, codec, ext):
+    src, dst = tmp_path / "in.flac", tmp_path / ("out." + ext)
+    _silence(src, layout)
+    res = asyncio.run(ffmpeg_conv(str(src), str(dst), codec, "64k"))
+    assert res["success"], res["msg"]
+    assert res["cmd"] == ["pyav"]
+    with av.open(str(dst)) as out:
+        stream = out.streams.audio[0]
+        return stream.layout.name, stream.rate
+
+
+def test_pyav_conv_keeps_supported_layout(tmp_path):
+    # libopus does not support 44.1 kHz
+    assert _convert(tmp_path, "stereo", "libopus", "ogg") == ("stereo", 48000)
+
+
+def test_pyav_conv_downmixes_unsupported_layout(tmp_path):
+    # libmp3lame only does mono and stereo; ffmpeg downmixes 5.1 to stereo
+    assert _convert(tmp_path, "5.1", "libmp3lame", "mp3") == ("stereo", 44100)